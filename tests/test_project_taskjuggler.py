@@ -20,6 +20,62 @@ class TestCase(unittest.TestCase):
         'Test depends'
         test_depends()
 
+    def test0010format_task(self):
+        'Test format_task'
+        from trytond.modules.project_taskjuggler.work import format_task
+
+        class Record(object):
+            def __init__(self, **values):
+                self.__dict__.update(values)
+
+        def task(**values):
+            defaults = {
+                'code': 'T1',
+                'timesheet_work_name': u'Task "one"',
+                'parent': Record(id=10),
+                'tracker': Record(id=2),
+                'state': 'opened',
+                'taskjuggler_hours': 3.5,
+                'priority': None,
+                'predecessors': [],
+                }
+            defaults.update(values)
+            return Record(**defaults)
+
+        header = (u'task taskT1  "T1-Task one"{\n'
+            u'    projectid p10\n')
+        effort = (u'        effort 3.5h\n'
+            u'        priority 500\n')
+
+        # No resources
+        self.assertEqual(format_task(task(), {}),
+            header + effort + u'\n}\n')
+        # One resource
+        self.assertEqual(format_task(task(), {2: [7]}),
+            header + effort
+            + u'            allocate rid7 {alternative  rid7 persistent}\n'
+            + u'\n}\n')
+        # Several resources
+        self.assertEqual(format_task(task(priority=10), {2: [7, 8, 9]}),
+            header + u'        effort 3.5h\n'
+            u'        priority 10\n'
+            u'            allocate rid7 {alternative  rid8,  rid9 persistent}'
+            u'\n\n}\n')
+        # Predecessors
+        predecessors = [Record(taskjuggler_code='taskP.taskPt2.taskA'),
+            Record(taskjuggler_code='taskP.taskPt2.taskB')]
+        self.assertEqual(format_task(task(predecessors=predecessors), {}),
+            header + effort
+            + u'        depends taskP.taskPt2.taskA,taskP.taskPt2.taskB\n'
+            + u'\n}\n')
+        # Done without remaining hours has neither effort nor allocation
+        self.assertEqual(format_task(task(state='done', taskjuggler_hours=0),
+                {2: [7]}),
+            header + u'\n}\n')
+        # Done with remaining hours keeps its effort
+        self.assertEqual(format_task(task(state='done'), {}),
+            header + effort + u'\n}\n')
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -3,20 +3,54 @@
 # copyright notices and license terms.
 import os
 import logging
+import hashlib
 from tempfile import NamedTemporaryFile
-import codecs
 import subprocess
+import itertools
+from collections import defaultdict, OrderedDict
+from functools import wraps
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from trytond.model import fields, ModelSQL, ModelView
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval
-from datetime import datetime
+from trytond.tools import reduce_ids
+from trytond.transaction import Transaction
+from datetime import date, datetime
 
 try:
-    from jinja2 import Environment, FileSystemLoader
+    from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 except ImportError:
     logging.getLogger('project_taskjuggler').error(
         'Unable to import jinja2. Install jinja2 package.')
-
+else:
+    TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'template')
+    # Without directory Jinja2 uses a private per user directory and checks
+    # its owner before loading any bytecode from it
+    TEMPLATE_ENV = Environment(loader=FileSystemLoader(TEMPLATE_DIR),
+        auto_reload=False, cache_size=400,
+        bytecode_cache=FileSystemBytecodeCache())
+
+
+# Coalesce the small chunks yielded by the template streams
+EXPORT_BUFSIZE = 1024 * 1024
+
+# Tasks are rendered once per work, so they are formatted with plain strings
+# instead of a Jinja2 include
+TASK_FMT = (u'task task{code}  "{code}-{name}"{{\n'
+    u'    projectid p{project}\n'
+    u'{effort}{depends}\n'
+    u'}}\n')
+EFFORT_FMT = (u'        effort {hours}h\n'
+    u'        priority {priority}\n'
+    u'{allocate}')
+ALLOCATE_FMT = (u'            allocate rid{first} {{alternative {alternatives}'
+    u' rid{last} persistent}}\n')
+DEPENDS_FMT = u'        depends {depends}\n'
+
+# Values memoized by export_cache for each running export, by export id
+EXPORT_CACHES = {}
+EXPORT_IDS = itertools.count()
 
 __metaclass__ = PoolMeta
 __all__ = ['TaskJuggler', 'Work', 'EmployeeTrackers', 'Employee',
@@ -24,9 +58,65 @@ __all__ = ['TaskJuggler', 'Work', 'EmployeeTrackers', 'Employee',
 
 
 def command(cmd):
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, close_fds=False)
     output, err = process.communicate()
-    return output, err
+    return output, err, process.returncode
+
+
+def safe_command(cmd):
+    'Run command returning the exception raised, if any, as its error'
+    try:
+        return command(cmd)
+    except Exception as e:
+        return '', str(e), None
+
+
+def safe_commands(cmds):
+    'Run the commands one after the other with safe_command'
+    return [safe_command(cmd) for cmd in cmds]
+
+
+def export_cache(func):
+    '''
+    Memoize a Work classmethod getter by record id while an export is running,
+    which TaskJuggler.export announces with the taskjuggler_export id in the
+    context. Only the records not computed yet are passed to the getter.
+    '''
+    @wraps(func)
+    def wrapper(cls, records, name):
+        cache = EXPORT_CACHES.get(
+            Transaction().context.get('taskjuggler_export'))
+        if cache is None:
+            return func(cls, records, name)
+        missing = [r for r in records
+            if (func.__name__, r.id) not in cache]
+        if missing:
+            for id_, value in func(cls, missing, name).iteritems():
+                cache[(func.__name__, id_)] = value
+        return dict((r.id, cache[(func.__name__, r.id)]) for r in records)
+    return wrapper
+
+
+def format_task(task, tracker_to_emps):
+    'Return the TaskJuggler definition of the task'
+    effort = depends = u''
+    if task.state != 'done' or task.taskjuggler_hours > 0.1:
+        resources = tracker_to_emps.get(task.tracker.id, [])
+        allocate = u''
+        if resources:
+            allocate = ALLOCATE_FMT.format(first=resources[0],
+                alternatives=u''.join(u' rid%s, ' % r
+                    for r in resources[1:-1]),
+                last=resources[-1])
+        effort = EFFORT_FMT.format(hours=task.taskjuggler_hours,
+            priority=task.priority or 500, allocate=allocate)
+    if task.predecessors:
+        depends = DEPENDS_FMT.format(depends=u','.join(
+                p.taskjuggler_code for p in task.predecessors))
+    return TASK_FMT.format(code=task.code,
+        name=task.timesheet_work_name.replace('"', '')[:40],
+        project=task.parent.id, effort=effort, depends=depends)
 
 
 class EmployeeTrackers(ModelSQL):
@@ -39,6 +129,28 @@ class EmployeeTrackers(ModelSQL):
     tracker = fields.Many2One('project.work.tracker', 'Tracker',
         ondelete='CASCADE', select=True)
 
+    @classmethod
+    def get_tracker_employees(cls, tracker_ids=None):
+        '''
+        Return a dict with the employee ids of each tracker in tracker_ids or
+        of all the trackers if it is None
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        employees = defaultdict(list)
+        if tracker_ids is None:
+            wheres = [None]
+        else:
+            wheres = [reduce_ids(table.tracker,
+                    tracker_ids[i:i + cursor.IN_MAX])
+                for i in range(0, len(tracker_ids), cursor.IN_MAX)]
+        for where in wheres:
+            cursor.execute(*table.select(table.tracker, table.employee,
+                    where=where, order_by=table.employee))
+            for tracker, employee in cursor.fetchall():
+                employees[tracker].append(employee)
+        return employees
+
 
 class Employee:
     __name__ = 'company.employee'
@@ -48,12 +160,15 @@ class Employee:
     holidays = fields.Function(fields.One2Many('holidays_employee.event',
         None, 'holidays'), 'get_holidays')
 
-    def get_holidays(self, name):
+    @classmethod
+    def get_holidays(cls, employees, name):
         Calendar = Pool().get('holidays_employee.calendar')
-        calendars = Calendar.search([('employee', '=', self)])
-        holidays = []
+        calendars = Calendar.search([
+                ('employee', 'in', [e.id for e in employees]),
+                ])
+        holidays = dict((e.id, []) for e in employees)
         for calendar in calendars:
-            holidays += [x.id for x in calendar.events]
+            holidays[calendar.employee.id] += [x.id for x in calendar.events]
 
         return holidays
 
@@ -76,52 +191,94 @@ class Work:
     taskjuggler_hours = fields.Function(fields.Float('Remain Hours'),
         'calc_remain_hours')
 
-    def calc_remain_hours(self, name=None):
-        effort = self.effort or 4.0
-        hours = self.hours or 0.0
-        res = effort - hours
-        if effort - hours <= 0 and self.state == 'opened':
-            res = 4.0 + (hours - effort)
-        if self.state == 'done':
-            res = 0
-        return res
-
-    def get_taskjuggler_code(self, name=None):
-        return "task%s.task%st%s.task%s" % (self.parent.code,
-            self.parent.code, self.tracker.id, self.code)
-
-    def get_resources(self, name=None):
-        Employee = Pool().get('company.employee')
-        employees = Employee.search([])
-        return [x.id for x in employees if self.tracker in x.trackers]
-
-    def get_trackers(self, name=None):
-        trackers = set()
-        for task in self.taskjuggler_tasks:
-            trackers.add(task.tracker.id)
-        return list(trackers)
-
-    def get_dependencies(self):
-        if not self.predecessors:
-            return []
-
-        dependencies = []
-        for task in self.predecessors:
-            dependencies.append(task)
-            dependencies += task.get_dependencies()
-        return dependencies
-
-    def get_tasks(self, name=None):
-        tasks = self.search([
-                ('parent', '=', self.id),
-                ('state', '=', 'opened'),
-                ])
+    @classmethod
+    def calc_remain_hours(cls, works, name):
+        remain_hours = {}
+        for work in works:
+            effort = work.effort or 4.0
+            hours = work.hours or 0.0
+            res = effort - hours
+            if effort - hours <= 0 and work.state == 'opened':
+                res = 4.0 + (hours - effort)
+            if work.state == 'done':
+                res = 0
+            remain_hours[work.id] = res
+        return remain_hours
+
+    @classmethod
+    def get_taskjuggler_code(cls, works, name):
+        codes = {}
+        for work in works:
+            parent_code = work.parent.code
+            codes[work.id] = 'task%s.task%st%s.task%s' % (parent_code,
+                parent_code, work.tracker.id, work.code)
+        return codes
+
+    @classmethod
+    def get_resources(cls, works, name):
+        pool = Pool()
+        Employee = pool.get('company.employee')
+        EmployeeTrackers = pool.get('project.tracker-company.employee')
+        tracker_ids = list(set(w.tracker.id for w in works if w.tracker))
+        employees = EmployeeTrackers.get_tracker_employees(tracker_ids)
+        # The relation table is read without record rules, keep only the
+        # employees the user can see
+        allowed = set(e.id for e in Employee.search([
+                    ('id', 'in', list(set(i for ids in employees.itervalues()
+                                for i in ids))),
+                    ]))
+        return dict((w.id, [e for e in employees.get(w.tracker.id, [])
+                    if e in allowed] if w.tracker else [])
+            for w in works)
 
-        dependencies = []
-        for task in tasks:
-            dependencies += task.get_dependencies()
+    @classmethod
+    @export_cache
+    def get_trackers(cls, works, name):
+        tasks = dict((w.id, [t.id for t in w.taskjuggler_tasks])
+            for w in works)
+        task_ids = list(set(i for ids in tasks.itervalues() for i in ids))
+        task_trackers = dict((r['id'], r['tracker'])
+            for r in cls.read(task_ids, ['tracker']))
+        return dict((work_id, list({task_trackers[i] for i in ids
+                        if task_trackers[i]}))
+            for work_id, ids in tasks.iteritems())
+
+    def get_dependencies(self, visited=None):
+        '''
+        Add the ids of the transitive predecessors of the work to visited and
+        return it. The works already in visited are not walked again.
+        '''
+        if visited is None:
+            visited = set()
+
+        frontier = set(t.id for t in self.predecessors)
+        while frontier:
+            frontier -= visited
+            visited |= frontier
+            # Browse the whole level at once so the predecessors of all its
+            # works are read together
+            tasks = self.browse(list(frontier))
+            frontier = set(p.id for t in tasks for p in t.predecessors)
+        return visited
 
-        return list(set([task.id for task in tasks + dependencies]))
+    @classmethod
+    @export_cache
+    def get_tasks(cls, works, name):
+        children = dict((w.id, []) for w in works)
+        for task in cls.search([
+                    ('parent', 'in', [w.id for w in works]),
+                    ('state', '=', 'opened'),
+                    ]):
+            children[task.parent.id].append(task)
+
+        tasks = {}
+        for work in works:
+            visited = set()
+            for task in children[work.id]:
+                task.get_dependencies(visited)
+            tasks[work.id] = list(set(t.id for t in children[work.id])
+                | visited)
+        return tasks
 
 
 class TaskJugglerProjectWork(ModelSQL):
@@ -160,12 +317,19 @@ class TaskJuggler(ModelSQL, ModelView):
         'the children of the work. Used for planning of Planned Works only.')
     exported_date = fields.DateTime('Exported', required=True, readonly=True)
     exported_msg = fields.Text('Exported Message', readonly=True)
+    exported_hash = fields.Char('Exported Hash', readonly=True,
+        help='Digest of the last TaskJuggler file compiled without errors.')
+    _tpl_project = None
+    _tpl_resource = None
+    _tpl_line = None
+    _tpl_report = None
 
     @classmethod
     def __setup__(cls):
         super(TaskJuggler, cls).__setup__()
         cls._buttons.update({
-            'export': {}
+            'export': {},
+            'force_export': {},
             })
         cls._error_messages.update({
                 'taskjuggler_result': ('TaskJuggler Compilation Result %s:\n '
@@ -177,48 +341,145 @@ class TaskJuggler(ModelSQL, ModelView):
         return True
 
     def get_project_ids(self, name=None):
-        ids = []
-        for project in self.projects:
-            ids.append('p%s' % project.id)
-        return ",".join(ids)
+        return ','.join('p%d' % p.id for p in self.projects)
 
     @classmethod
-    @ModelView.button
-    def export(cls, projects):
+    def load_templates(cls):
+        'Compile the export templates once and keep them on the class'
+        if cls._tpl_project is None:
+            cls._tpl_project = TEMPLATE_ENV.get_template('project.jinja')
+            cls._tpl_resource = TEMPLATE_ENV.get_template('resource.jinja')
+            cls._tpl_line = TEMPLATE_ENV.get_template('project_line.jinja')
+            cls._tpl_report = TEMPLATE_ENV.get_template('reports.jinja')
+
+    @classmethod
+    def get_employees(cls):
+        '''
+        Return the id, name and holidays of all the employees as dicts with
+        only the values used by resource.jinja
+        '''
         pool = Pool()
         Employee = pool.get('company.employee')
+        Party = pool.get('party.party')
+        Event = pool.get('holidays_employee.event')
+
+        # Keep a stable order so the exported file only changes with its data
+        employees = sorted(Employee.read(Employee.search([]),
+                ['party', 'holidays']), key=lambda e: e['id'])
+        names = dict((p['id'], p['name']) for p in Party.read(
+                list(set(e['party'] for e in employees)), ['name']))
+        events = dict((e['id'], e) for e in Event.read(
+                [h for e in employees for h in e['holidays']],
+                ['start_date', 'end_date']))
+        return [{
+                'id': e['id'],
+                'name': names[e['party']],
+                'holidays': [events[h] for h in e['holidays']],
+                } for e in employees]
 
-        for project in projects:
-            template_dir = os.path.join(os.path.dirname(__file__), 'template')
-            template_loader = FileSystemLoader(searchpath=template_dir)
-            template_env = Environment(loader=template_loader)
-
-            #export project
-            project_template = template_env.get_template('project.jinja')
-            project_tjp = project_template.render(project=project)
-
-            employees = Employee.search([])
-            employee_template = template_env.get_template('resource.jinja')
-            employee_tjp = employee_template.render(employees=employees)
-
-            line_template = template_env.get_template('project_line.jinja')
-            line_tjp = line_template.render(lines=project.projects,
-                planned_works=project.planned_works)
-
-            report_template = template_env.get_template('reports.jinja')
-            report_tjp = report_template.render(lines=project.projects)
-
-            tjpf = NamedTemporaryFile(suffix=".tjp", delete=False)
-            tjpfc = codecs.open(tjpf.name, "w", "utf-8")
-            tjpfc.write(project_tjp)
-            tjpfc.write(employee_tjp)
-            tjpfc.write(line_tjp)
-            tjpfc.write(report_tjp)
-            tjpfc.close()
-
-            cmd = ['tj3', '--output-dir', project.output,
-                tjpf.name]
-            result, error = command(cmd)
-            project.exported_date = datetime.now()
-            project.expored_msg = result
-            project.save()
+    @classmethod
+    @ModelView.button
+    def force_export(cls, projects):
+        'Export running tj3 even if the file has not changed'
+        with Transaction().set_context(taskjuggler_force=True):
+            cls.export(projects)
+
+    @classmethod
+    @ModelView.button
+    def export(cls, projects):
+        pool = Pool()
+        EmployeeTrackers = pool.get('project.tracker-company.employee')
+
+        cls.load_templates()
+        # Resources do not depend on the project, render them only once
+        employees = cls.get_employees()
+        employee_tjp = cls._tpl_resource.render(
+            employees=employees).encode('utf-8')
+
+        # Only allocate employees that have a resource in the file
+        employee_ids = set(e['id'] for e in employees)
+        tracker_to_emps = dict((tracker, [e for e in emps
+                    if e in employee_ids])
+            for tracker, emps in
+            EmployeeTrackers.get_tracker_employees().iteritems())
+
+        force = Transaction().context.get('taskjuggler_force')
+        export_id = next(EXPORT_IDS)
+        EXPORT_CACHES[export_id] = {}
+        filenames = []
+        jobs = []
+        try:
+            for project in projects:
+                # Share the tasks and trackers computed for the works between
+                # the templates. Only the export id is put in the context as it
+                # is part of the cache keys of the records and the access rules
+                with Transaction().set_context(taskjuggler_export=export_id), \
+                        NamedTemporaryFile(suffix='.tjp', mode='wb',
+                            bufsize=EXPORT_BUFSIZE, delete=False) as tjpf:
+                    filenames.append(tjpf.name)
+                    #export project
+                    cls._tpl_project.stream(project=project).dump(tjpf,
+                        encoding='utf-8')
+                    tjpf.write(employee_tjp)
+                    cls._tpl_line.stream(lines=project.projects,
+                        planned_works=project.planned_works,
+                        tracker_to_emps=tracker_to_emps,
+                        format_task=format_task).dump(tjpf,
+                        encoding='utf-8')
+                    cls._tpl_report.stream(lines=project.projects).dump(tjpf,
+                        encoding='utf-8')
+
+                # Do not compile again a file identical to the last one the
+                # same day, as the reports depend on the current date, while
+                # its reports are still there
+                digest = hashlib.sha1((project.output or '').encode('utf-8'))
+                digest.update(date.today().isoformat())
+                with open(tjpf.name, 'rb') as tjp:
+                    for chunk in iter(lambda: tjp.read(EXPORT_BUFSIZE), ''):
+                        digest.update(chunk)
+                exported_hash = digest.hexdigest()
+                if (not force and exported_hash == project.exported_hash
+                        and project.output
+                        and os.path.isfile(os.path.join(project.output,
+                                'Index.html'))):
+                    continue
+
+                jobs.append((project, tjpf.name, exported_hash))
+            # The memo is only needed to render the files
+            del EXPORT_CACHES[export_id]
+
+            if not jobs:
+                return
+            # tj3 writes the same report files in every output directory, so
+            # only the directories are compiled at the same time and the
+            # projects sharing one are compiled one after the other
+            groups = OrderedDict()
+            for job in jobs:
+                groups.setdefault(job[0].output, []).append(job)
+            threads = ThreadPool(min(len(groups), cpu_count()))
+            try:
+                group_results = threads.map(safe_commands, [
+                        [['tj3', '--output-dir', project.output, filename]
+                            for project, filename, _ in group]
+                        for group in groups.itervalues()])
+            finally:
+                threads.close()
+            jobs = [job for group in groups.itervalues() for job in group]
+            results = [r for rs in group_results for r in rs]
+
+            to_write = []
+            for (project, _, exported_hash), (result, error,
+                    returncode) in zip(jobs, results):
+                if error:
+                    result += error
+                to_write.extend(([project], {
+                            'exported_date': datetime.now(),
+                            'exported_msg': result,
+                            'exported_hash': (exported_hash if returncode == 0
+                                else None),
+                            }))
+            cls.write(*to_write)
+        finally:
+            EXPORT_CACHES.pop(export_id, None)
+            for filename in filenames:
+                os.remove(filename)